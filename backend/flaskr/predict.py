@@ -3,8 +3,7 @@ from flaskr import utils
 from flaskr.evaluation_result import EvaluationResult
 
 bp = Blueprint('predict', __name__, url_prefix="/predict")
-# bp.record_once(sql2text_bridge.setup_checkpoints)
-# bp.record_once(sql2text_bridge.setup_models)
+# bp.record_once(sql2text_bridge.setup_in_background)
 
 
 @bp.route('/', methods=('GET', 'POST'))
@@ -1,4 +1,11 @@
-import traceback
+import argparse
+import contextlib
+import inspect
+import itertools
+import threading
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple, List
 from flask import current_app
 from flaskr import file_utils
@@ -6,7 +13,7 @@ from flaskr.evaluation_result import EvaluationResult
 
 import torch
 from torch.utils.data import Dataset
-from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
 
 from Data.dataset import SeqDataset, TreeDataset
 from Data.utils import get_seq_batch_data, get_tree_batch_data
@@ -15,19 +22,71 @@ from Utils.const import TYPE_NUM
 from Utils.metric import get_metric
 
 MAX_DECODE = 500
+TEST_DATASET_CACHE_SIZE = 32
 TRAIN_SEQ_DATASET_KEY = "train_seq_dataset"
 TRAIN_TREE_DATASET_KEY = "train_tree_dataset"
 TRAIN_TABLE_FILE_PATH = "Dataset/spider/tables.json"
 SUPPORTED_MODELS = ["BiLSTM", "Relative-Transformer",
                     "Transformer", "TreeLSTM"]
+AUTOCAST_MODELS = ["Relative-Transformer", "Transformer"]
 TRAIN_DATA_FILES = [
     "./Dataset/spider_composed_tree2seq/train.json",
 ]
 
-device = torch.device("cuda:0")
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+# mmap loading and meta-device construction need torch >= 2.1
+SUPPORTS_MMAP_LOAD = "mmap" in inspect.signature(torch.load).parameters
+SUPPORTS_ASSIGN_LOAD = "assign" in inspect.signature(
+    torch.nn.Module.load_state_dict).parameters
+# torch.device as a default-device context manager needs torch >= 2.0
+SUPPORTS_DEVICE_CONTEXT = hasattr(torch.device, "__enter__")
+# weights_only loading with allowlisted non-tensor globals needs torch >= 2.4
+SUPPORTS_SAFE_GLOBALS = hasattr(torch.serialization, "add_safe_globals")
+# decode step is compiled once per cached model, the decode loop marks cudagraph
+# steps between calls which needs torch.compiler.cudagraph_mark_step_begin (torch >= 2.1)
+SUPPORTS_COMPILE = (hasattr(torch, "compile") and device.type == "cuda"
+                    and hasattr(getattr(torch, "compiler", None), "cudagraph_mark_step_begin"))
+# without torch.compile the decode step is captured as a cuda graph by hand
+SUPPORTS_CUDA_GRAPH = (not SUPPORTS_COMPILE and device.type == "cuda"
+                       and hasattr(torch.cuda, "CUDAGraph") and hasattr(torch.cuda, "graph"))
+CUDA_GRAPH_WARMUP_STEPS = 3
+DECODE_GRAPH_CACHE_SIZE = 16
+DECODE_GRAPH_MIN_SEEN = 2
+DECODE_GRAPH_SEEN_SIZE = 256
+# torch.inference_mode needs torch >= 1.9, device generic torch.autocast torch >= 1.10
+SUPPORTS_INFERENCE_MODE = hasattr(torch, "inference_mode")
+SUPPORTS_AUTOCAST = hasattr(torch, "autocast")
+# without torch.compile the decode step is traced with torch.jit on first use
+SUPPORTS_JIT_TRACE = not SUPPORTS_COMPILE
 train_seq_dataset: Dataset = None
 train_tree_dataset: Dataset = None
+# set once the corresponding setup has fully finished, read by is_ready()
+checkpoints_ready = threading.Event()
+datasets_ready = threading.Event()
 checkpoint_dict: dict = {}
+# built models are device-resident and reused across requests, keyed by model name
+model_cache: dict = {}
+model_cache_locks: dict = {name: threading.Lock() for name in SUPPORTED_MODELS}
+# captured decode graphs keyed by (model name, decode input shapes), None once capture
+# has failed for them, least recently used evicted
+decode_graph_cache: OrderedDict = OrderedDict()
+# how often not yet captured decode input shapes were seen, least recently seen evicted
+decode_graph_seen: OrderedDict = OrderedDict()
+decode_graph_cache_lock = threading.Lock()
+# traced decode modules keyed by (model name, decode input dtypes and ranks), None once
+# tracing has failed for them
+traced_decode_cache: dict = {}
+traced_decode_cache_lock = threading.Lock()
+# pinned host buffers reused for batch H2D copies, one flat buffer per dtype in
+# each slot, slots are used round robin and guarded by the event of their last copy
+STAGING_SLOTS = 2
+staging_slots: list = [{'buffers': {}, 'event': None} for _ in range(STAGING_SLOTS)]
+staging_next_slot = 0
+staging_stream = None
+staging_lock = threading.Lock()
+# test datasets keyed by (dataset kind, request file content), least recently used evicted
+test_dataset_cache: OrderedDict = OrderedDict()
+test_dataset_cache_lock = threading.Lock()
 
 
 def predict(model:str, db_id:str, gold_nl_array:str, input_sql:str, input_identifier:str) -> EvaluationResult:
@@ -58,7 +117,7 @@ def predict(model:str, db_id:str, gold_nl_array:str, input_sql:str, input_identi
 
 
 def is_ready():
-    return len(checkpoint_dict) != 0 and train_seq_dataset != None and train_tree_dataset != None
+    return checkpoints_ready.is_set() and datasets_ready.is_set()
 
 
 def setup_checkpoints(_):
@@ -68,37 +127,93 @@ def setup_checkpoints(_):
         path = get_checkpoint_path(model)
         current_app.logger.info(f"loading checkpoint {path} for model '{model}'...")
         # print(f"[setup_checkpoints] loading checkpoint {path} for model '{model}'...")
-        checkpoint_dict[model] = torch.load(path)
+        checkpoint = load_checkpoint(path)
+        # keep references only, tensors stay mmapped until the model is built
+        checkpoint_dict[model] = {'args': checkpoint['args'], 'model': checkpoint['model']}
         # print(f"[setup_checkpoints] checkpoint {path} loaded!")
         current_app.logger.info(f"checkpoint {path} loaded!")
 
     # print("!!setup_checkpoints finished!!")
+    checkpoints_ready.set()
     current_app.logger.info("!!setup_checkpoints finished!!")
 
 
+def load_checkpoint(path: str) -> dict:
+    """
+    load checkpoint tensors onto cpu, never onto the device they were saved from
+    """
+    load_kwargs = {'map_location': 'cpu'}
+    if SUPPORTS_MMAP_LOAD:
+        load_kwargs['mmap'] = True
+    if SUPPORTS_SAFE_GLOBALS:
+        # checkpoints pickle their training args as argparse.Namespace
+        torch.serialization.add_safe_globals([argparse.Namespace])
+        load_kwargs['weights_only'] = True
+
+    return torch.load(path, **load_kwargs)
+
+
+def pin_state_dict(state_dict: dict):
+    """
+    pin float tensors in place so the first H2D copy can run asynchronously,
+    only done when the model is built to keep unused checkpoints paged out
+    """
+    if device.type != 'cuda' or not torch.cuda.is_available():
+        return
+
+    for key, value in state_dict.items():
+        if value.is_floating_point():
+            state_dict[key] = value.pin_memory()
+
+
 def setup_models(_):
     # no app_context in this method, current_app not avialable
     global train_seq_dataset
     global train_tree_dataset
-    if train_seq_dataset is None:
-        # print(f"[setup_models] generating {TRAIN_SEQ_DATASET_KEY}...")
-        current_app.logger.info(f"generating {TRAIN_SEQ_DATASET_KEY}...")
-        train_seq_dataset = SeqDataset(
-            TRAIN_DATA_FILES, TRAIN_TABLE_FILE_PATH)
-        # print(f"[setup_models] {TRAIN_SEQ_DATASET_KEY} generated!")
-        current_app.logger.info(f"{TRAIN_SEQ_DATASET_KEY} generated!")
-    if train_tree_dataset is None:
-        # print(f"[setup_models] generating {TRAIN_TREE_DATASET_KEY}...")
-        current_app.logger.info(f"generating {TRAIN_TREE_DATASET_KEY}...")
-        train_tree_dataset = TreeDataset(
-            TRAIN_DATA_FILES, TRAIN_TABLE_FILE_PATH)
-        # print(f"[setup_models] {TRAIN_TREE_DATASET_KEY} generated!")
-        current_app.logger.info(f"{TRAIN_TREE_DATASET_KEY} generated!")
+    # both datasets are built from the same files independently
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        seq_future = None
+        tree_future = None
+        if train_seq_dataset is None:
+            current_app.logger.info(f"generating {TRAIN_SEQ_DATASET_KEY}...")
+            seq_future = executor.submit(
+                SeqDataset, TRAIN_DATA_FILES, TRAIN_TABLE_FILE_PATH)
+        if train_tree_dataset is None:
+            current_app.logger.info(f"generating {TRAIN_TREE_DATASET_KEY}...")
+            tree_future = executor.submit(
+                TreeDataset, TRAIN_DATA_FILES, TRAIN_TABLE_FILE_PATH)
+
+        if seq_future is not None:
+            train_seq_dataset = seq_future.result()
+            current_app.logger.info(f"{TRAIN_SEQ_DATASET_KEY} generated!")
+        if tree_future is not None:
+            train_tree_dataset = tree_future.result()
+            current_app.logger.info(f"{TRAIN_TREE_DATASET_KEY} generated!")
 
     # print("!!setup_models finished!!")
+    datasets_ready.set()
     current_app.logger.info("!!setup_models finished!!")
 
 
+def setup_in_background(state):
+    """
+    run setup_checkpoints and setup_models concurrently without blocking startup,
+    meant for Blueprint.record_once, poll is_ready() for completion
+    """
+    app = state.app
+
+    def run_with_context(setup):
+        with app.app_context():
+            try:
+                setup(state)
+            except Exception as err:
+                # is_ready() stays false, leave the reason in the log
+                app.logger.exception("%s failed: %s", setup.__name__, err)
+
+    for setup in [setup_checkpoints, setup_models]:
+        threading.Thread(target=run_with_context, args=(setup,), daemon=True).start()
+
+
 def get_checkpoint_path(model: str) -> str:
     """
     return empty string if model not supported
@@ -136,19 +251,33 @@ def get_train_dataset(model: str) -> Dataset:
 
 
 def build_dataset(model: str, user_request_data_file: str) -> Dataset:
-    test_data_files = [user_request_data_file]
-
-    test_set = None
+    """
+    the seq models of one request share a test file content, build it only once
+    """
     if model in ['Relative-Transformer', 'Transformer', 'BiLSTM']:
-        train_set = get_train_dataset(model)
-        test_set = SeqDataset(
-            test_data_files, TRAIN_TABLE_FILE_PATH, vocab=train_set.vocab)
+        dataset_class = SeqDataset
     elif model == 'TreeLSTM':
-        train_set = get_train_dataset(model)
-        test_set = TreeDataset(
-            test_data_files, TRAIN_TABLE_FILE_PATH, vocab=train_set.vocab)
+        dataset_class = TreeDataset
     else:
         current_app.logger.error("not supported model %s", model)
+        return None
+
+    with open(user_request_data_file, 'r') as fp:
+        cache_key = (dataset_class.__name__, fp.read())
+
+    with test_dataset_cache_lock:
+        if cache_key in test_dataset_cache:
+            test_dataset_cache.move_to_end(cache_key)
+            return test_dataset_cache[cache_key]
+
+    train_set = get_train_dataset(model)
+    test_set = dataset_class(
+        [user_request_data_file], TRAIN_TABLE_FILE_PATH, vocab=train_set.vocab)
+
+    with test_dataset_cache_lock:
+        test_dataset_cache[cache_key] = test_set
+        if len(test_dataset_cache) > TEST_DATASET_CACHE_SIZE:
+            test_dataset_cache.popitem(last=False)
 
     return test_set
 
@@ -193,44 +322,446 @@ def build_model(args, vocab) -> torch.nn.Module:
     return None
 
 
+def build_model_from_meta(model: str, checkpoint: dict, vocab) -> torch.nn.Module:
+    """
+    build without allocating weights, then adopt the mmapped checkpoint tensors,
+    return None if the model cannot be fully materialized this way
+    """
+    with torch.device('meta'):
+        torch_model = build_model(checkpoint['args'], vocab)
+    if torch_model is None:
+        return None
+
+    # adopted tensors become the model weights, pin them for the async move to device
+    pin_state_dict(checkpoint['model'])
+    torch_model.load_state_dict(checkpoint['model'], assign=True)
+    # non-persistent buffers are not in the state_dict and would stay on meta
+    if any(t.is_meta for t in itertools.chain(torch_model.parameters(), torch_model.buffers())):
+        current_app.logger.warning(
+            "model '%s' has tensors outside its state_dict, build it eagerly", model)
+        return None
+
+    return torch_model
+
+
+def get_cached_model(model: str, checkpoint: dict, vocab) -> torch.nn.Module:
+    """
+    build model on first use and cache it, return None if build failed
+    """
+    if model in model_cache:
+        return model_cache[model]
+
+    with model_cache_locks[model]:
+        # another request may have finished building while we were waiting
+        if model in model_cache:
+            return model_cache[model]
+
+        torch_model = None
+        if SUPPORTS_ASSIGN_LOAD:
+            torch_model = build_model_from_meta(model, checkpoint, vocab)
+        if torch_model is not None:
+            torch_model.to(device, non_blocking=True)
+        elif SUPPORTS_DEVICE_CONTEXT:
+            # parameters are allocated on device, checkpoint is copied into them once
+            with device:
+                torch_model = build_model(checkpoint['args'], vocab)
+            if torch_model is None:
+                return None
+            torch_model.load_state_dict(checkpoint['model'])
+        else:
+            torch_model = build_model(checkpoint['args'], vocab)
+            if torch_model is None:
+                return None
+            # load on cpu first so only checkpoint weights cross to the device
+            torch_model.load_state_dict(checkpoint['model'])
+            torch_model.to(device)
+        if device.type == 'cuda':
+            # pinned host tensors are released below, wait for async copies first
+            torch.cuda.synchronize(device)
+        torch_model.eval()
+        if device.type == 'cpu':
+            # dynamic int8 quantization is cpu only
+            torch_model = torch.quantization.quantize_dynamic(
+                torch_model, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8)
+        if SUPPORTS_COMPILE:
+            # evaluate drives encode/decode directly, forward is never called
+            torch_model.decode = torch.compile(
+                torch_model.decode, mode='reduce-overhead', fullgraph=False)
+        model_cache[model] = torch_model
+        # weights now live in the cached model, keep only args on host
+        checkpoint_dict[model] = {'args': checkpoint['args']}
+        current_app.logger.info("model '%s' built and cached", model)
+        return torch_model
+
+
+def count_staged_numels(item, numels: dict):
+    if torch.is_tensor(item):
+        numels[item.dtype] = numels.get(item.dtype, 0) + item.numel()
+    elif isinstance(item, (list, tuple)):
+        for sub_item in item:
+            count_staged_numels(sub_item, numels)
+
+
+def stage_to_device(batch: tuple) -> tuple:
+    """
+    copy cpu tensors of a batch, including those nested in lists and tuples, to device
+    through pinned staging buffers, other items that support .to(device) are moved
+    directly and the rest are returned as is
+    """
+    global staging_stream, staging_next_slot
+    if device.type != 'cuda':
+        return batch
+
+    numels = {}
+    count_staged_numels(batch, numels)
+
+    with staging_lock:
+        if staging_stream is None:
+            # copies run on their own stream so they never queue behind decode work
+            staging_stream = torch.cuda.Stream(device)
+        slot = staging_slots[staging_next_slot]
+        staging_next_slot = (staging_next_slot + 1) % STAGING_SLOTS
+        # only wait for the copies that last read this slot's buffers
+        if slot['event'] is not None:
+            slot['event'].synchronize()
+
+        buffers = slot['buffers']
+        for dtype, numel in numels.items():
+            buffer = buffers.get(dtype)
+            if buffer is None or buffer.numel() < numel:
+                buffers[dtype] = torch.empty(numel, dtype=dtype, pin_memory=True)
+
+        consumer_stream = torch.cuda.current_stream(device)
+        offsets = dict.fromkeys(numels, 0)
+
+        def stage(item):
+            if isinstance(item, (list, tuple)):
+                return type(item)(stage(sub_item) for sub_item in item)
+            if not torch.is_tensor(item):
+                if hasattr(item, 'to'):
+                    with torch.cuda.stream(consumer_stream):
+                        return item.to(device)
+                return item
+            offset = offsets[item.dtype]
+            host = buffers[item.dtype][offset:offset + item.numel()].view(item.shape)
+            host.copy_(item)
+            offsets[item.dtype] = offset + item.numel()
+            staged_item = host.to(device, non_blocking=True)
+            # allocated on the staging stream, used on the consumer stream
+            staged_item.record_stream(consumer_stream)
+            return staged_item
+
+        with torch.cuda.stream(staging_stream):
+            staged = stage(tuple(batch))
+            slot['event'] = torch.cuda.Event()
+            slot['event'].record(staging_stream)
+
+        consumer_stream.wait_event(slot['event'])
+
+    return staged
+
+
+def copy_nested(dst, src):
+    if torch.is_tensor(dst):
+        dst.copy_(src)
+        return
+    if isinstance(dst, (list, tuple)):
+        for dst_item, src_item in zip(dst, src):
+            copy_nested(dst_item, src_item)
+
+
+def clone_nested(src):
+    if torch.is_tensor(src):
+        return src.clone()
+    if isinstance(src, (list, tuple)):
+        return type(src)(clone_nested(item) for item in src)
+    return src
+
+
+def nested_shape(src):
+    if torch.is_tensor(src):
+        return (src.dtype, tuple(src.shape))
+    if isinstance(src, (list, tuple)):
+        return tuple(nested_shape(item) for item in src)
+    return src
+
+
+def nested_signature(src):
+    if torch.is_tensor(src):
+        return (src.dtype, src.dim())
+    if isinstance(src, (list, tuple)):
+        return tuple(nested_signature(item) for item in src)
+    return src
+
+
+def trace_decode(model, model_name, example_inputs):
+    """
+    trace model.decode with example_inputs, return None if tracing failed or had
+    to bake python values into the trace
+    """
+    try:
+        # catch_warnings swaps the process-wide filters, callers serialize tracing
+        # so concurrent traces do not restore each other's filters
+        with warnings.catch_warnings():
+            # a TracerWarning means some value (a length, an .item()) was recorded as
+            # a constant, the trace would silently decode other input lengths wrong
+            warnings.simplefilter("error", torch.jit.TracerWarning)
+            traced = torch.jit.trace_module(model, {'decode': example_inputs}, strict=False)
+    except (RuntimeError, torch.jit.TracerWarning) as err:
+        current_app.logger.warning("trace decode for %s failed, fall back to eager: %s",
+                                   model_name, err)
+        return None
+
+    try:
+        traced = torch.jit.optimize_for_inference(traced, other_methods=['decode'])
+    except (RuntimeError, AttributeError, TypeError) as err:
+        current_app.logger.warning("optimize traced decode for %s failed: %s", model_name, err)
+    return traced
+
+
+def get_traced_decode(model, model_name, example_inputs):
+    """
+    return model.decode traced with torch.jit on first use, or model.decode itself
+    if tracing is not supported or failed, traces are shared across input lengths
+    """
+    if not SUPPORTS_JIT_TRACE:
+        return model.decode
+
+    # dtypes and ranks only, traces that depend on exact lengths are rejected when traced
+    key = (model_name, nested_signature(example_inputs))
+    with traced_decode_cache_lock:
+        if key not in traced_decode_cache:
+            traced_decode_cache[key] = trace_decode(model, model_name, example_inputs)
+        traced = traced_decode_cache[key]
+
+    return model.decode if traced is None else traced.decode
+
+
+def capture_decode_graph(decode, model_name, decode_args: tuple):
+    """
+    capture one decode step over static copies of decode_args,
+    return None if the step cannot be captured
+    """
+    static_args = clone_nested(decode_args)
+    try:
+        warmup_stream = torch.cuda.Stream(device)
+        warmup_stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.cuda.stream(warmup_stream):
+            for _ in range(CUDA_GRAPH_WARMUP_STEPS):
+                decode(*static_args)
+        torch.cuda.current_stream(device).wait_stream(warmup_stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_out, static_hidden_out = decode(*static_args)
+    except RuntimeError as err:
+        current_app.logger.warning("capture decode graph for %s failed, fall back to eager: %s",
+                                   model_name, err)
+        return None
+
+    # replay feeds hidden_out back into the static hidden, their layouts must match
+    if (not torch.is_tensor(static_out)
+            or nested_shape(static_hidden_out) != nested_shape(static_args[2])):
+        current_app.logger.warning(
+            "decode graph for %s returns a hidden state unlike its input, fall back to eager",
+            model_name)
+        return None
+
+    return {'graph': graph, 'static_args': static_args, 'out': static_out,
+            'hidden_out': static_hidden_out, 'lock': threading.Lock()}
+
+
+def get_decode_graph(decode, model_name, decode_args: tuple):
+    """
+    return the cached decode graph for these input shapes, capturing it once the shapes
+    have been seen DECODE_GRAPH_MIN_SEEN times, None before that or if capture failed
+    """
+    key = (model_name, nested_shape(decode_args))
+    with decode_graph_cache_lock:
+        if key in decode_graph_cache:
+            decode_graph_cache.move_to_end(key)
+            return decode_graph_cache[key]
+        # one-off source lengths would pay warmup and capture without ever replaying
+        seen = decode_graph_seen.pop(key, 0) + 1
+        if seen < DECODE_GRAPH_MIN_SEEN:
+            decode_graph_seen[key] = seen
+            if len(decode_graph_seen) > DECODE_GRAPH_SEEN_SIZE:
+                decode_graph_seen.popitem(last=False)
+            return None
+
+    entry = capture_decode_graph(decode, model_name, decode_args)
+    with decode_graph_cache_lock:
+        decode_graph_cache[key] = entry
+        if len(decode_graph_cache) > DECODE_GRAPH_CACHE_SIZE:
+            decode_graph_cache.popitem(last=False)
+    return entry
+
+
+@contextlib.contextmanager
+def decode_session(model, model_name, inputs, nodes, hidden, mask, copy_mask, src2trg_map):
+    """
+    yield step(inputs, hidden) -> (cur_out, hidden) for one batch, replaying a
+    cached cuda graph when possible and falling back to plain decode otherwise
+    """
+    decode = get_traced_decode(
+        model, model_name, (inputs, nodes, hidden, mask, copy_mask, src2trg_map))
+
+    def eager_step(step_inputs, step_hidden):
+        if SUPPORTS_COMPILE:
+            # outputs of the previous cudagraph replay are fed back as inputs
+            torch.compiler.cudagraph_mark_step_begin()
+        return decode(step_inputs, nodes, step_hidden, mask, copy_mask, src2trg_map)
+
+    entry = None
+    # TreeLSTM batches differ in structure, its decode is not captured
+    if SUPPORTS_CUDA_GRAPH and model_name != "TreeLSTM":
+        entry = get_decode_graph(
+            decode, model_name, (inputs, nodes, hidden, mask, copy_mask, src2trg_map))
+    # static buffers of a graph belong to one batch at a time, decode eagerly while busy
+    if entry is None or not entry['lock'].acquire(blocking=False):
+        yield eager_step
+        return
+
+    try:
+        static_inputs, static_nodes, static_hidden, static_mask, static_copy_mask, \
+            static_src2trg_map = entry['static_args']
+        copy_nested((static_nodes, static_mask, static_copy_mask, static_src2trg_map),
+                    (nodes, mask, copy_mask, src2trg_map))
+
+        def graph_step(step_inputs, step_hidden):
+            static_inputs.copy_(step_inputs)
+            # the previous replay's hidden output is read before it gets overwritten
+            copy_nested(static_hidden, step_hidden)
+            entry['graph'].replay()
+            return entry['out'], entry['hidden_out']
+
+        yield graph_step
+    finally:
+        entry['lock'].release()
+
+
+def iter_batches(dataset: Dataset, batch_size: int):
+    """
+    same batches as DataLoader(dataset, batch_size) without building a loader per request
+    """
+    for start in range(0, len(dataset), batch_size):
+        end = min(start + batch_size, len(dataset))
+        yield default_collate([dataset[i] for i in range(start, end)])
+
+
+def inference_context():
+    if SUPPORTS_INFERENCE_MODE:
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+def autocast_context(enabled: bool):
+    """
+    cuda fp16 autocast, no autocast object is built when disabled so cpu
+    requests never construct an unsupported cpu fp16 autocast
+    """
+    if not enabled:
+        return contextlib.nullcontext()
+    if SUPPORTS_AUTOCAST:
+        # captured decode graphs must not read the weight cast cache, it is freed
+        # when autocast exits while the graphs stay cached
+        return torch.autocast(device_type="cuda", dtype=torch.float16,
+                              cache_enabled=not SUPPORTS_CUDA_GRAPH)
+    return torch.cuda.amp.autocast()
+
+
+def copy_predictions_to_host(preds: torch.Tensor) -> tuple:
+    """
+    start copying predictions into pinned host memory, return (host_preds, event)
+    for collect_host_predictions, event is None when nothing is in flight
+    """
+    if preds.device.type != 'cuda':
+        return preds, None
+
+    host_preds = torch.empty(preds.shape, dtype=preds.dtype, pin_memory=True)
+    host_preds.copy_(preds, non_blocking=True)
+    event = torch.cuda.Event()
+    event.record(torch.cuda.current_stream(preds.device))
+    return host_preds, event
+
+
+def collect_host_predictions(pending: tuple) -> List[List[int]]:
+    host_preds, event = pending
+    if event is not None:
+        event.synchronize()
+    return host_preds.tolist()
+
+
 def evaluate(model: torch.nn.Module, dataset, vocab, args, model_name) -> Tuple[str, float]:
     if model_name not in SUPPORTED_MODELS:
         return "", 0
 
     model.eval()
-    dataloader = DataLoader(dataset, args.eval_batch_size)
     all_predictions = []
-
-    for batch_data in dataloader:
-        preds = []
-        if model_name in ["Relative-Transformer", "Transformer", "BiLSTM"]:
-            batch, _ = get_seq_batch_data(
-                batch_data, vocab.pad_idx, device, vocab.size, vocab.unk_idx, args.down_max_dist)
-            nodes, questions, rela_dist, copy_mask, src2trg_map = batch
-            if model_name == "Relative-Transformer":
-                nodes, hidden, mask = model.encode(nodes, rela_dist)
-            else:  # "Transformer", "BiLSTM"
-                nodes, hidden, mask = model.encode(nodes)
-        elif model_name == "TreeLSTM":
-            batch, _ = get_tree_batch_data(batch_data, device)
-            nodes, types, node_order, adjacency_list, edge_order, questions, copy_mask, src2trg_map = batch
-            nodes, hidden, mask = model.encode(
-                nodes, types, node_order, adjacency_list, edge_order)
-        else:
-            current_app.logger.error("not supported model %s", model_name)
-            return "", 0
-
-        inputs = questions[:, 0].view(-1, 1)
-        for _ in range(MAX_DECODE):
-            cur_out, hidden = model.decode(
-                inputs, nodes, hidden, mask, copy_mask, src2trg_map)
-            next_input = cur_out.argmax(dim=-1)
-            preds.append(next_input)
-            next_input[next_input >= vocab.size] = vocab.unk_idx
-            inputs = next_input
-
-        preds = torch.cat(preds, dim=1)
-        all_predictions += preds.tolist()
+    pending_predictions = None
+    # vocab comes from the external Data package, decode the full length without an eos id
+    eos_idx = getattr(vocab, "eos_idx", None)
+    # batches are built on cpu and copied through the pinned staging buffers
+    batch_device = torch.device("cpu") if device.type == "cuda" else device
+
+    # LSTM based models are kept in full precision, only transformers run under fp16
+    use_autocast = device.type == "cuda" and model_name in AUTOCAST_MODELS
+    with inference_context(), autocast_context(use_autocast):
+        for batch_data in iter_batches(dataset, args.eval_batch_size):
+            if model_name in ["Relative-Transformer", "Transformer", "BiLSTM"]:
+                batch, _ = get_seq_batch_data(
+                    batch_data, vocab.pad_idx, batch_device, vocab.size, vocab.unk_idx, args.down_max_dist)
+                batch = stage_to_device(batch)
+                nodes, questions, rela_dist, copy_mask, src2trg_map = batch
+                if model_name == "Relative-Transformer":
+                    nodes, hidden, mask = model.encode(nodes, rela_dist)
+                else:  # "Transformer", "BiLSTM"
+                    nodes, hidden, mask = model.encode(nodes)
+            elif model_name == "TreeLSTM":
+                batch, _ = get_tree_batch_data(batch_data, batch_device)
+                batch = stage_to_device(batch)
+                nodes, types, node_order, adjacency_list, edge_order, questions, copy_mask, src2trg_map = batch
+                nodes, hidden, mask = model.encode(
+                    nodes, types, node_order, adjacency_list, edge_order)
+            else:
+                current_app.logger.error("not supported model %s", model_name)
+                return "", 0
+
+            if pending_predictions is not None:
+                # previous batch's copy ran while this batch was built and encoded
+                all_predictions += collect_host_predictions(pending_predictions)
+                pending_predictions = None
+
+            # decode-step invariants, made contiguous once instead of per step
+            nodes, mask, copy_mask, src2trg_map = [
+                t.contiguous() if torch.is_tensor(t) else t
+                for t in (nodes, mask, copy_mask, src2trg_map)]
+            inputs = questions[:, 0].view(-1, 1)
+            preds = torch.empty((inputs.size(0), MAX_DECODE), dtype=torch.long, device=device)
+            finished = torch.zeros(inputs.size(0), dtype=torch.bool, device=device)
+            decoded_len = MAX_DECODE
+            with decode_session(model, model_name, inputs, nodes, hidden,
+                                mask, copy_mask, src2trg_map) as decode_step:
+                for step in range(MAX_DECODE):
+                    cur_out, hidden = decode_step(inputs, hidden)
+                    # decode input is always [batch, 1], whether cur_out keeps its step dim or not
+                    next_input = cur_out.argmax(dim=-1).view(-1, 1)
+                    next_input = next_input.masked_fill(next_input >= vocab.size, vocab.unk_idx)
+                    # predictions record the ids after oov tokens are mapped to unk
+                    preds[:, step] = next_input[:, 0]
+                    inputs = next_input
+                    # get_metric cuts each prediction at eos, nothing after it is used
+                    if eos_idx is None:
+                        continue
+                    finished |= preds[:, step] == eos_idx
+                    if finished.all():
+                        decoded_len = step + 1
+                        break
+
+            pending_predictions = copy_predictions_to_host(preds[:, :decoded_len])
+
+    if pending_predictions is not None:
+        all_predictions += collect_host_predictions(pending_predictions)
 
     _, scores, result_predictions, _ = get_metric(all_predictions, dataset.origin_questions, vocab,
                                           True, dataset.val_map_list, dataset.idx2tok_map_list)
@@ -261,26 +792,24 @@ def run_sql2text(model: str, user_input_json_path: str, result:EvaluationResult)
             result.failedReason = reason
             return
 
-        model = build_model(checkpoint_args, test_dataset.vocab)
-        if model is None:
+        torch_model = get_cached_model(model, checkpoint, test_dataset.vocab)
+        if torch_model is None:
             reason = f"build model for {model} failed"
             current_app.logger.error(reason)
             result.failedReason = reason
             return
 
-        model.to(device)
-        model.load_state_dict(checkpoint['model'])
-        current_app.logger.info(
+        current_app.logger.debug(
             "%s is ready, start evaluate...", checkpoint_args.model)
         prediction, score = evaluate(
-            model, test_dataset, test_dataset.vocab, checkpoint_args, checkpoint_args.model)
+            torch_model, test_dataset, test_dataset.vocab, checkpoint_args, checkpoint_args.model)
         result.result = prediction
         result.score = score
         result.success = True
 
     except Exception as err:
-        current_app.logger.error(err)
-        current_app.logger.error(traceback.format_exc())
+        # traceback is only formatted if a handler emits the record
+        current_app.logger.exception(err)
         result.failedReason = str(err)
         return
 